@@ -1,4 +1,16 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
+
+# header fields filled from lower-scored pages when the base page lacks them
+_FILL_KEYS = ("invoiceDate", "paymentTerms", "total")
+
+def _score(d: Dict[str, Any]) -> Tuple[int, int]:
+    # (header fields present, line item count), compared lexicographically
+    return (
+        (1 if d.get("total") else 0)
+        + (1 if d.get("invoiceDate") else 0)
+        + (1 if d.get("paymentTerms") else 0),
+        len(d.get("lineItems", [])),
+    )
 
 def merge_documents_by_invoice_number(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
@@ -18,22 +30,17 @@ def merge_documents_by_invoice_number(docs: List[Dict[str, Any]]) -> List[Dict[s
 
     merged: List[Dict[str, Any]] = []
     for inv_no, group in groups.items():
-        def score(d: Dict[str, Any]) -> float:
-            return sum([
-                1 if d.get("total") else 0,
-                1 if d.get("invoiceDate") else 0,
-                1 if d.get("paymentTerms") else 0,
-                len(d.get("lineItems", [])) / 1000.0
-            ])
-        group_sorted = sorted(group, key=score, reverse=True)
-        base = group_sorted[0].copy()
-        for other in group_sorted[1:]:
-            if not base.get("invoiceDate")   and other.get("invoiceDate"):   base["invoiceDate"] = other["invoiceDate"]
-            if not base.get("paymentTerms")  and other.get("paymentTerms"):  base["paymentTerms"] = other["paymentTerms"]
-            if not base.get("total")         and other.get("total"):         base["total"] = other["total"]
-
+        if len(group) == 1:
+            merged.append({**group[0], "lineItems": list(group[0].get("lineItems", []))})
+            continue
+        # key is evaluated once per doc; stable sort keeps page order among ties
+        ordered = sorted(group, key=_score, reverse=True)
+        base = dict(ordered[0])
         all_items: List[Dict[str, Any]] = []
-        for d in group_sorted:
+        for d in ordered:
+            for k in _FILL_KEYS:
+                if not base.get(k) and d.get(k):
+                    base[k] = d[k]
             all_items.extend(d.get("lineItems", []))
         base["lineItems"] = all_items
         merged.append(base)
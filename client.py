@@ -1,12 +1,21 @@
-import os, uuid, mimetypes, time
+import os, uuid, mimetypes, time, random, threading
 from pathlib import Path
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, Tuple, Iterator
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
 #  env / clients 
 
+# Textract Get* calls are throttled at ~5 TPS per account
+GET_TPS_QUOTA = 5.0
+
+# part uploads in flight per file (see UPLOAD_TRANSFER_CONFIG)
+UPLOAD_MAX_CONCURRENCY = 8
+
 def load_config():
     load_dotenv()
     cfg = {
@@ -14,16 +23,25 @@ def load_config():
         "S3_BUCKET": os.getenv("S3_BUCKET"),
         "S3_PREFIX": os.getenv("S3_PREFIX", "invoices/"),
         "POLL_SECS": float(os.getenv("POLL_SECS", "4")),
+        "PARALLEL": max(1, int(os.getenv("PARALLEL", "5"))),
+        # start the FORMS fallback job alongside Expense (costs a job even if unused)
+        "SPECULATIVE_FORMS": os.getenv("SPECULATIVE_FORMS", "0") == "1",
     }
     if not cfg["S3_BUCKET"]:
         raise ValueError("S3_BUCKET is not set.")
+    # keep aggregate polling (workers / poll_secs) under the Get* quota
+    cfg["POLL_SECS"] = max(cfg["POLL_SECS"], cfg["PARALLEL"] / GET_TPS_QUOTA)
     return cfg
 
 def get_textract_client(region: str):
-    return boto3.client("textract", region_name=region)
+    # throttling is retried in _call_with_retry; botocore retrying too would multiply attempts
+    return boto3.client("textract", region_name=region,
+                        config=Config(retries={"mode": "standard", "max_attempts": 1}))
 
-def get_s3_client(region: str):
-    return boto3.client("s3", region_name=region)
+def get_s3_client(region: str, workers: int = 1):
+    # one pooled connection per concurrent part upload across all workers sharing this client
+    pool = max(10, workers * UPLOAD_MAX_CONCURRENCY)
+    return boto3.client("s3", region_name=region, config=Config(max_pool_connections=pool))
 
 #  S3 helpers 
 
@@ -33,6 +51,15 @@ ALLOWED_EXTS = {".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff"}
 # Async (StartExpenseAnalysis) supports only PDF/TIFF
 ASYNC_EXTS = {".pdf", ".tif", ".tiff"}
 
+# Multipart upload in 8 MiB parts, several in flight, so large PDFs aren't a single PUT
+MIB = 1024 * 1024
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * MIB,
+    multipart_chunksize=8 * MIB,
+    max_concurrency=UPLOAD_MAX_CONCURRENCY,
+    use_threads=True,
+)
+
 def _guess_content_type(path: Path) -> str:
     ctype, _ = mimetypes.guess_type(str(path))
     return ctype or "application/octet-stream"
@@ -54,7 +81,11 @@ def upload_local_file_to_s3(local_path: str, bucket: str, prefix: str, s3_client
         raise ValueError(f"Only {sorted(ALLOWED_EXTS)} supported. Got: {p.suffix}")
     key = _make_s3_key_from_local(p, prefix)
     print(f"Uploading {p.name} → s3://{bucket}/{key}")
-    s3_client.upload_file(str(p), bucket, key, ExtraArgs={"ContentType": _guess_content_type(p)})
+    s3_client.upload_file(
+        str(p), bucket, key,
+        ExtraArgs={"ContentType": _guess_content_type(p)},
+        Config=UPLOAD_TRANSFER_CONFIG,
+    )
     return key
 
 
@@ -66,30 +97,94 @@ def _is_async_supported_ext(key: str) -> bool:
 
 #  Textract (Expense) APIs 
 
+TERMINAL_STATUSES = ("SUCCEEDED", "FAILED", "PARTIAL_SUCCESS")
+
+# first poll delay; grows by POLL_BACKOFF up to poll_secs
+POLL_START_SECS = 0.5
+POLL_BACKOFF = 1.5
+
+def _sleep_with_jitter(delay: float) -> None:
+    time.sleep(delay + random.uniform(0, delay * 0.2))
+
+class _TokenBucket:
+    """
+    Thread-safe token bucket shared by every Textract Get* call, so all
+    worker threads together stay under the account's Get* TPS quota.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_GET_BUCKET = _TokenBucket(rate=GET_TPS_QUOTA, capacity=GET_TPS_QUOTA)
+
+THROTTLE_CODES = {"ProvisionedThroughputExceededException", "ThrottlingException"}
+MAX_THROTTLE_RETRIES = 5
+THROTTLE_START_SECS = 1.0
+
+def _call_with_retry(func, **kwargs) -> Dict[str, Any]:
+    """
+    Rate-limited Textract Get* call; retries with backoff when throttled.
+    """
+    delay = THROTTLE_START_SECS
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        _GET_BUCKET.acquire()
+        try:
+            return func(**kwargs)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in THROTTLE_CODES or attempt == MAX_THROTTLE_RETRIES:
+                raise
+            print(f"[throttled] {code}; retrying in ~{delay:.1f}s")
+            _sleep_with_jitter(delay)
+            delay *= 2
+
 # ASYNC (PDF/TIFF)
 def start_expense_job(bucket: str, key: str, textract) -> str:
     r = textract.start_expense_analysis(DocumentLocation={"S3Object": {"Bucket": bucket, "Name": key}})
     return r["JobId"]
 
 def wait_for_job(job_id: str, textract, poll_secs: float) -> str:
+    delay = min(POLL_START_SECS, poll_secs)
     while True:
-        r = textract.get_expense_analysis(JobId=job_id)
+        r = _call_with_retry(textract.get_expense_analysis, JobId=job_id)
         status = r["JobStatus"]
         print(f"[{job_id}] Status: {status}")
-        if status in ("SUCCEEDED", "FAILED", "PARTIAL_SUCCESS"):
+        if status in TERMINAL_STATUSES:
             return status
-        time.sleep(poll_secs)
+        _sleep_with_jitter(delay)
+        delay = min(delay * POLL_BACKOFF, poll_secs)
 
-def fetch_all_pages(job_id: str, textract) -> List[Dict[str, Any]]:
-    pages, token = [], None
+def iter_all_pages(job_id: str, textract) -> Iterator[Dict[str, Any]]:
+    """
+    Yield GetExpenseAnalysis result pages one at a time, following NextToken.
+    """
+    token = None
     while True:
-        r = textract.get_expense_analysis(JobId=job_id, NextToken=token) if token else textract.get_expense_analysis(JobId=job_id)
-        pages.append(r)
+        kwargs = {"JobId": job_id}
+        if token:
+            kwargs["NextToken"] = token
+        r = _call_with_retry(textract.get_expense_analysis, **kwargs)
+        yield r
         token = r.get("NextToken")
         if not token:
             break
-        time.sleep(0.2)
-    return pages
+
+def fetch_all_pages(job_id: str, textract) -> List[Dict[str, Any]]:
+    return list(iter_all_pages(job_id, textract))
 
 # SYNC (works for PNG/JPG/TIFF/PDF)
 def analyze_expense_s3object(bucket: str, key: str, textract):
@@ -137,21 +232,25 @@ def start_forms_job(bucket: str, key: str, textract) -> str:
     return r["JobId"]
 
 def wait_for_forms_job(job_id: str, textract, poll_secs: float) -> str:
+    delay = min(POLL_START_SECS, poll_secs)
     while True:
-        r = textract.get_document_analysis(JobId=job_id)
+        r = _call_with_retry(textract.get_document_analysis, JobId=job_id)
         status = r["JobStatus"]
         print(f"[FORMS {job_id}] Status: {status}")
-        if status in ("SUCCEEDED", "FAILED", "PARTIAL_SUCCESS"):
+        if status in TERMINAL_STATUSES:
             return status
-        time.sleep(poll_secs)
+        _sleep_with_jitter(delay)
+        delay = min(delay * POLL_BACKOFF, poll_secs)
 
 def fetch_all_pages_forms(job_id: str, textract) -> List[Dict[str, Any]]:
     pages, token = [], None
     while True:
-        r = textract.get_document_analysis(JobId=job_id, NextToken=token) if token else textract.get_document_analysis(JobId=job_id)
+        kwargs = {"JobId": job_id}
+        if token:
+            kwargs["NextToken"] = token
+        r = _call_with_retry(textract.get_document_analysis, **kwargs)
         pages.append(r)
         token = r.get("NextToken")
         if not token:
             break
-        time.sleep(0.2)
     return pages
@@ -1,11 +1,32 @@
 import re
-from typing import Dict, Any, List, Optional, Tuple
+from dataclasses import dataclass
+from functools import lru_cache, wraps
+from typing import Dict, Any, Callable, Iterable, List, Optional, Tuple
 from decimal import Decimal
 from utils import (
-    clean_text, normalize_date, to_decimal_maybe, to_decimal_qty,
+    clean_text, normalize_date,
+    to_decimal_maybe as _to_decimal_maybe, to_decimal_qty as _to_decimal_qty,
     compute_amount_if_missing, compute_qty_if_missing, is_currency_like
 )
 
+# text with no digit can't be a number; reject it without entering the parser
+_HAS_DIGIT_RX = re.compile(r"\d")
+
+# the same cell text is parsed several times per line item; memoize string inputs
+def _cache_str_arg(fn: Callable[[Any], Optional[Decimal]]) -> Callable[[Any], Optional[Decimal]]:
+    cached = lru_cache(maxsize=8192)(fn)
+    @wraps(fn)
+    def wrapper(s):
+        if not isinstance(s, str):
+            return fn(s)
+        if not _HAS_DIGIT_RX.search(s):
+            return None
+        return cached(s)
+    return wrapper
+
+to_decimal_maybe = _cache_str_arg(_to_decimal_maybe)
+to_decimal_qty   = _cache_str_arg(_to_decimal_qty)
+
 # header label regex 
 LABEL_FLAGS = re.IGNORECASE
 RE_INV_NUM   = [re.compile(r"\b(invoice|inv)\s*(no\.?|number|#)\b", LABEL_FLAGS)]
@@ -17,61 +38,84 @@ RE_TERMS     = [re.compile(r"\bpayment\s*terms\b", LABEL_FLAGS),
                 re.compile(r"\bpayment\s*due\b", LABEL_FLAGS),
                 re.compile(r"\bterms\b", LABEL_FLAGS)]
 
+def _fuse(patterns: List[re.Pattern]) -> re.Pattern:
+    return re.compile("|".join(f"(?:{p.pattern})" for p in patterns), LABEL_FLAGS)
+
+# one alternation per label list, so each label is scanned once
+RE_INV_NUM_U  = _fuse(RE_INV_NUM)
+RE_INV_DATE_U = _fuse(RE_INV_DATE)
+RE_TOTAL_U    = _fuse(RE_TOTAL)
+RE_TERMS_U    = _fuse(RE_TERMS)
+
 # FORMS parsing (fallback) 
+def _word_text(cb: Dict[str, Any]) -> str:
+    bt = cb.get("BlockType")
+    if bt == "WORD":
+        return cb.get("Text", "")
+    if bt == "SELECTION_ELEMENT" and cb.get("SelectionStatus") == "SELECTED":
+        return "X"
+    return ""
+
 def _get_text_from_block(block: Dict[str, Any], id_map: Dict[str, Dict[str, Any]]) -> str:
-    parts: List[str] = []
-    for rel in block.get("Relationships", []) or []:
-        if rel.get("Type") == "CHILD":
-            for cid in rel.get("Ids", []):
-                cb = id_map.get(cid, {})
-                if cb.get("BlockType") == "WORD":
-                    parts.append(cb.get("Text", ""))
-                elif cb.get("BlockType") == "SELECTION_ELEMENT" and cb.get("SelectionStatus") == "SELECTED":
-                    parts.append("X")
-    return " ".join([t for t in parts if t]).strip()
+    return " ".join(
+        t
+        for rel in (block.get("Relationships") or ())
+        if rel.get("Type") == "CHILD"
+        for cid in rel.get("Ids", ())
+        for t in (_word_text(id_map.get(cid, {})),)
+        if t
+    ).strip()
 
 def parse_forms_key_values(pages: List[Dict[str, Any]]) -> Dict[str, str]:
     kv: Dict[str, str] = {}
     for page in pages:
         blocks = page.get("Blocks", []) or []
-        id_map = {b["Id"]: b for b in blocks if "Id" in b}
+        # index only blocks reachable from KEY_VALUE_SETs (their words + VALUE sets)
+        key_blocks: List[Dict[str, Any]] = []
+        referenced_ids = set()
         for b in blocks:
-            if b.get("BlockType") == "KEY_VALUE_SET" and "KEY" in (b.get("EntityTypes") or []):
-                key_txt = _get_text_from_block(b, id_map)
-                value_txt = ""
+            if b.get("BlockType") == "KEY_VALUE_SET":
                 for rel in b.get("Relationships", []) or []:
-                    if rel.get("Type") == "VALUE":
-                        for vid in rel.get("Ids", []):
-                            vb = id_map.get(vid, {})
-                            value_txt = _get_text_from_block(vb, id_map) or value_txt
-                key_norm = (key_txt or "").strip().lower()
-                val_norm = (value_txt or "").strip()
-                if key_norm:
-                    if key_norm not in kv or not kv[key_norm]:
-                        kv[key_norm] = val_norm
+                    referenced_ids.update(rel.get("Ids", []))
+                if "KEY" in (b.get("EntityTypes") or []):
+                    key_blocks.append(b)
+        if not key_blocks:
+            continue
+        id_map = {b["Id"]: b for b in blocks if b.get("Id") in referenced_ids}
+        for b in key_blocks:
+            key_txt = _get_text_from_block(b, id_map)
+            value_txt = ""
+            for rel in b.get("Relationships", []) or []:
+                if rel.get("Type") == "VALUE":
+                    for vid in rel.get("Ids", []):
+                        vb = id_map.get(vid, {})
+                        value_txt = _get_text_from_block(vb, id_map) or value_txt
+            key_norm = (key_txt or "").strip().lower()
+            val_norm = (value_txt or "").strip()
+            if key_norm:
+                if key_norm not in kv or not kv[key_norm]:
+                    kv[key_norm] = val_norm
     return kv
 
 #  Expense helpers 
-def get_summary_value_by_type(summary_fields: List[Dict[str, Any]], type_name: str) -> Optional[str]:
-    for f in summary_fields:
-        if (f.get("Type") or {}).get("Text") == type_name:
-            vd = f.get("ValueDetection") or {}
-            text = vd.get("Text")
-            if text:
-                return text
-    return None
-
-def get_summary_value_by_label(summary_fields: List[Dict[str, Any]], label_regexes: List[re.Pattern]) -> Optional[str]:
+def _index_summary_fields(summary_fields: List[Dict[str, Any]]) -> Tuple[Dict[str, str], List[Tuple[str, str]]]:
+    """
+    One pass over SummaryFields: first non-empty value per Type, plus
+    (lowercased label, value) pairs in document order.
+    """
+    types_map: Dict[str, str] = {}
+    labels: List[Tuple[str, str]] = []
     for f in summary_fields:
-        lbl = ((f.get("LabelDetection") or {}).get("Text") or "").strip()
-        val = (f.get("ValueDetection") or {}).get("Text")
-        if not lbl or not val:
+        txt = (f.get("ValueDetection") or {}).get("Text")
+        if not txt:
             continue
-        lbl_norm = lbl.lower()
-        for rx in label_regexes:
-            if rx.search(lbl_norm):
-                return val
-    return None
+        tt = (f.get("Type") or {}).get("Text")
+        if tt:
+            types_map.setdefault(tt, txt)
+        lbl = ((f.get("LabelDetection") or {}).get("Text") or "").strip().lower()
+        if lbl:
+            labels.append((lbl, txt))
+    return types_map, labels
 
 #  helpers for candidate scoring 
 def _close(a: Optional[Decimal], b: Optional[Decimal]) -> bool:
@@ -105,11 +149,127 @@ def _soft_rate_bonus(s: str) -> Decimal:
         bonus += Decimal("0.03")  
     return bonus
 
+def _score_pairs(qd: Decimal,
+                 rates: List[Tuple[Decimal, Decimal]],
+                 amounts: List[Tuple[Decimal, Decimal]]) -> Optional[Tuple[int, int]]:
+    """
+    Return (rate_idx, amount_idx) of the (value, bonus) pair whose qty*rate
+    best matches amount, or None if either list is empty.
+    """
+    best: Optional[Tuple[int, int]] = None
+    best_err = Decimal("1e9")
+    for i, (rd, rb) in enumerate(rates):
+        expected = (qd * rd).quantize(Decimal("0.01"))
+        for j, (ad, ab) in enumerate(amounts):
+            err = (expected - ad).copy_abs() + rb + ab
+            if qd >= 1 and ad < rd:  # when qty>=1, amount usually >= rate
+                err += Decimal("0.10")
+            if err < best_err:
+                best, best_err = (i, j), err
+    return best
+
+#  line item field extraction 
+QUANTITY_KEYS    = frozenset({"QUANTITY", "QTY", "HOURS", "HOUR", "UNITS"})
+UNIT_PRICE_KEYS  = frozenset({"UNIT_PRICE", "PRICE", "RATE"})
+AMOUNT_KEYS      = frozenset({"AMOUNT", "TOTAL", "LINE_TOTAL", "NET_AMOUNT", "LINE_AMOUNT", "AMOUNT_AFTER_DISCOUNT"})
+DESC_KEYS        = frozenset({"ITEM", "DESCRIPTION", "PRODUCT_CODE", "SERVICE"})
+
+RATE_LABEL_RE   = re.compile(r"\b(rate|unit price|price)\b", re.I)
+AMOUNT_LABEL_RE = re.compile(r"\b(amount|line amount|line total|total)\b", re.I)
+QTY_LABEL_RE    = re.compile(r"\b(hours?|qty|quantity|units?|pcs?)\b", re.I)
+DESC_LABEL_RE   = re.compile(r"\b(description|item|service)\b", re.I)
+
+def li_extract(fields: List[Dict[str, Any]], total_hint_num: Optional[Decimal]) -> Dict[str, Optional[str]]:
+    desc = None
+    qty_raw = None
+    rate_cands: List[str] = []
+    amt_cands:  List[str] = []
+
+    #  TYPE-first collection (priority)
+    for f in fields:
+        t = ((f.get("Type") or {}).get("Text") or "").upper()
+        lbl = ((f.get("LabelDetection") or {}).get("Text") or "").strip()
+        val = (f.get("ValueDetection") or {}).get("Text") or ""
+        lbl_norm = lbl.lower()
+
+        if not desc and (t in DESC_KEYS or DESC_LABEL_RE.search(lbl_norm)):
+            desc = val.strip()
+
+        if (t in QUANTITY_KEYS) or QTY_LABEL_RE.search(lbl_norm):
+            if not qty_raw:
+                qty_raw = val
+
+        if t in UNIT_PRICE_KEYS:
+            _push_unique(rate_cands, val)
+        if t in AMOUNT_KEYS:
+            _push_unique(amt_cands, val)
+
+    #  LABEL-based collection (secondary)
+    for f in fields:
+        lbl = ((f.get("LabelDetection") or {}).get("Text") or "").strip().lower()
+        val = (f.get("ValueDetection") or {}).get("Text") or ""
+        if RATE_LABEL_RE.search(lbl):
+            _push_unique(rate_cands, val)
+        if AMOUNT_LABEL_RE.search(lbl):
+            _push_unique(amt_cands, val)
+
+    #  Remove row amounts that equal the invoice total (echoed on each row)
+    if total_hint_num is not None and amt_cands:
+        filtered = []
+        for a in amt_cands:
+            ad = to_decimal_maybe(a)
+            if ad is None or not _close(ad, total_hint_num):
+                filtered.append(a)
+        amt_cands = filtered or amt_cands
+
+    #  Choose best pair using qty with soft bonuses
+    qd = to_decimal_qty(qty_raw)
+    rate = amount = None
+
+    if qd is not None and rate_cands and amt_cands:
+        # parse each candidate and its bonus once, not once per pair
+        rates = [(r, rd) for r, rd in ((r, to_decimal_maybe(r)) for r in rate_cands) if rd is not None]
+        amts  = [(a, ad) for a, ad in ((a, to_decimal_maybe(a)) for a in amt_cands) if ad is not None]
+        best = _score_pairs(qd,
+                            [(rd, _soft_rate_bonus(r)) for r, rd in rates],
+                            [(ad, _soft_amount_bonus(a)) for a, ad in amts])
+        if best is not None:
+            rate, amount = rates[best[0]][0], amts[best[1]][0]
+
+    # If still missing, choose first available from candidates
+    if rate is None and rate_cands:
+        rate = rate_cands[0]
+    if amount is None and amt_cands:
+        amount = amt_cands[0]
+
+    #  Only compute missing value (do NOT overwrite existing)
+    if amount is None:
+        comp = compute_amount_if_missing(qty_raw, rate)
+        amount = f"{comp}" if comp is not None else None
+    if rate is None and qd is not None and amount:
+        ad = to_decimal_maybe(amount)
+        if ad is not None and qd != 0:
+            rate = f"{(ad / qd).quantize(Decimal('0.01'))}"
+
+    # If all present but inconsistent, try swapping rate<->amount
+    qd2 = to_decimal_qty(qty_raw)
+    rd2 = to_decimal_maybe(rate)
+    ad2 = to_decimal_maybe(amount)
+    if qd2 is not None and rd2 is not None and ad2 is not None:
+        exp = (qd2 * rd2).quantize(Decimal("0.01"))
+        if not _close(exp, ad2):
+            exp_swapped = (qd2 * ad2).quantize(Decimal("0.01"))
+            if _close(exp_swapped, rd2):
+                rate, amount = amount, rate
+
+    return {"description": desc, "quantity": qty_raw, "unitPrice": rate, "amount": amount}
+
 #  Expense normalized docs 
-def parse_expense_documents(results_pages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def parse_expense_documents(results_pages: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     Normalize Textract Expense output into a list of docs:
     { invoiceNumber, invoiceDate, total, paymentTerms, lineItems: [...] }
+    Pages are consumed once, so a streaming iterator works as input.
 
     - Uses TYPE-first then LABELs for line item fields
     - Chooses (unitPrice, amount) pair via qty-aware error minimization
@@ -119,131 +279,23 @@ def parse_expense_documents(results_pages: List[Dict[str, Any]]) -> List[Dict[st
     """
     parsed: List[Dict[str, Any]] = []
 
-    QUANTITY_KEYS    = {"QUANTITY", "QTY", "HOURS", "HOUR", "UNITS"}
-    UNIT_PRICE_KEYS  = {"UNIT_PRICE", "PRICE", "RATE"}
-    AMOUNT_KEYS      = {"AMOUNT", "TOTAL", "LINE_TOTAL", "NET_AMOUNT", "LINE_AMOUNT", "AMOUNT_AFTER_DISCOUNT"}
-    DESC_KEYS        = {"ITEM", "DESCRIPTION", "PRODUCT_CODE", "SERVICE"}
-
-    RATE_LABEL_RE   = re.compile(r"\b(rate|unit price|price)\b", re.I)
-    AMOUNT_LABEL_RE = re.compile(r"\b(amount|line amount|line total|total)\b", re.I)
-    QTY_LABEL_RE    = re.compile(r"\b(hours?|qty|quantity|units?|pcs?)\b", re.I)
-    DESC_LABEL_RE   = re.compile(r"\b(description|item|service)\b", re.I)
-
-    def li_extract(fields: List[Dict[str, Any]], total_hint_num: Optional[Decimal]) -> Dict[str, Optional[str]]:
-        desc = None
-        qty_raw = None
-        rate_cands: List[str] = []
-        amt_cands:  List[str] = []
-
-        #  TYPE-first collection (priority)
-        for f in fields:
-            t = ((f.get("Type") or {}).get("Text") or "").upper()
-            lbl = ((f.get("LabelDetection") or {}).get("Text") or "").strip()
-            val = (f.get("ValueDetection") or {}).get("Text") or ""
-            lbl_norm = lbl.lower()
-
-            if not desc and (t in DESC_KEYS or DESC_LABEL_RE.search(lbl_norm)):
-                desc = val.strip()
-
-            if (t in QUANTITY_KEYS) or QTY_LABEL_RE.search(lbl_norm):
-                if not qty_raw:
-                    qty_raw = val
-
-            if t in UNIT_PRICE_KEYS:
-                _push_unique(rate_cands, val)
-            if t in AMOUNT_KEYS:
-                _push_unique(amt_cands, val)
-
-        #  LABEL-based collection (secondary)
-        for f in fields:
-            lbl = ((f.get("LabelDetection") or {}).get("Text") or "").strip().lower()
-            val = (f.get("ValueDetection") or {}).get("Text") or ""
-            if RATE_LABEL_RE.search(lbl):
-                _push_unique(rate_cands, val)
-            if AMOUNT_LABEL_RE.search(lbl):
-                _push_unique(amt_cands, val)
-
-        #  Remove row amounts that equal the invoice total (echoed on each row)
-        if total_hint_num is not None and amt_cands:
-            filtered = []
-            for a in amt_cands:
-                ad = to_decimal_maybe(a)
-                if ad is None or not _close(ad, total_hint_num):
-                    filtered.append(a)
-            amt_cands = filtered or amt_cands
-
-        #  Choose best pair using qty with soft bonuses
-        qd = to_decimal_qty(qty_raw)
-        rate = amount = None
-
-        if qd is not None and rate_cands and amt_cands:
-            best_pair: Tuple[Optional[str], Optional[str], Decimal] = (None, None, Decimal("1e9"))
-            for r in rate_cands:
-                rd = to_decimal_maybe(r)
-                if rd is None:
-                    continue
-                for a in amt_cands:
-                    ad = to_decimal_maybe(a)
-                    if ad is None:
-                        continue
-                    expected = (qd * rd).quantize(Decimal("0.01"))
-                    err = (expected - ad).copy_abs()
-                    err += _soft_rate_bonus(r)
-                    err += _soft_amount_bonus(a)
-                    if qd >= 1 and ad < rd:  # when qty>=1, amount usually >= rate
-                        err += Decimal("0.10")
-                    if err < best_pair[2]:
-                        best_pair = (r, a, err)
-            if best_pair[0] is not None:
-                rate, amount = best_pair[0], best_pair[1]
-
-        # If still missing, choose first available from candidates
-        if rate is None and rate_cands:
-            rate = rate_cands[0]
-        if amount is None and amt_cands:
-            amount = amt_cands[0]
-
-        #  Only compute missing value (do NOT overwrite existing)
-        if amount is None:
-            comp = compute_amount_if_missing(qty_raw, rate)
-            amount = f"{comp}" if comp is not None else None
-        if rate is None and qd is not None and amount:
-            ad = to_decimal_maybe(amount)
-            if ad is not None and qd != 0:
-                rate = f"{(ad / qd).quantize(Decimal('0.01'))}"
-
-        # If all present but inconsistent, try swapping rate<->amount
-        qd2 = to_decimal_qty(qty_raw)
-        rd2 = to_decimal_maybe(rate)
-        ad2 = to_decimal_maybe(amount)
-        if qd2 is not None and rd2 is not None and ad2 is not None:
-            exp = (qd2 * rd2).quantize(Decimal("0.01"))
-            if not _close(exp, ad2):
-                exp_swapped = (qd2 * ad2).quantize(Decimal("0.01"))
-                if _close(exp_swapped, rd2):
-                    rate, amount = amount, rate
-
-        return {"description": desc, "quantity": qty_raw, "unitPrice": rate, "amount": amount}
-
     for page in results_pages:
         for doc in page.get("ExpenseDocuments", []):
             summary_fields   = doc.get("SummaryFields", [])
             line_item_groups = doc.get("LineItemGroups", [])
 
+            types_map, labels = _index_summary_fields(summary_fields)
+
             def sumval(*alts: str) -> Optional[str]:
-                for a in alts:
-                    v = get_summary_value_by_type(summary_fields, a)
-                    if v: return v
-                return None
-
-            invoice_number = sumval("INVOICE_RECEIPT_ID", "INVOICE_NUMBER") or \
-                             get_summary_value_by_label(summary_fields, RE_INV_NUM)
-            invoice_date   = sumval("INVOICE_RECEIPT_DATE", "INVOICE_DATE") or \
-                             get_summary_value_by_label(summary_fields, RE_INV_DATE)
-            total_amt      = sumval("TOTAL", "GRAND_TOTAL") or \
-                             get_summary_value_by_label(summary_fields, RE_TOTAL)
-            payment_terms  = sumval("PAYMENT_TERMS", "TERMS") or \
-                             get_summary_value_by_label(summary_fields, RE_TERMS)
+                return next((types_map[a] for a in alts if a in types_map), None)
+
+            def labelval(label_regex: re.Pattern) -> Optional[str]:
+                return next((v for lbl, v in labels if label_regex.search(lbl)), None)
+
+            invoice_number = sumval("INVOICE_RECEIPT_ID", "INVOICE_NUMBER") or labelval(RE_INV_NUM_U)
+            invoice_date   = sumval("INVOICE_RECEIPT_DATE", "INVOICE_DATE") or labelval(RE_INV_DATE_U)
+            total_amt      = sumval("TOTAL", "GRAND_TOTAL") or labelval(RE_TOTAL_U)
+            payment_terms  = sumval("PAYMENT_TERMS", "TERMS") or labelval(RE_TERMS_U)
 
             total_hint_num = to_decimal_maybe(total_amt)
 
@@ -276,8 +328,17 @@ SUMMARY_RX = re.compile(
     re.IGNORECASE
 )
 
-def sanitize_line_items(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    cleaned: List[Dict[str, Any]] = []
+@dataclass
+class LineItem:
+    """Sanitized line item; numeric fields are Decimals (or None)."""
+    __slots__ = ("description", "quantity", "unitPrice", "amount")
+    description: Optional[str]
+    quantity:    Optional[Decimal]
+    unitPrice:   Optional[Decimal]
+    amount:      Optional[Decimal]
+
+def sanitize_line_items(items: List[Dict[str, Any]]) -> List[LineItem]:
+    cleaned: List[LineItem] = []
     for it in items or []:
         desc = clean_text(it.get("description"))
         qty  = clean_text(it.get("quantity"))
@@ -311,16 +372,12 @@ def sanitize_line_items(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         if not (desc or qty_d is not None or price_d is not None or amt_d is not None):
             continue
 
-        cleaned.append({
-            "description": desc,
-            "quantity": qty_d,
-            "unitPrice": price_d,
-            "amount": amt_d
-        })
+        cleaned.append(LineItem(desc, qty_d, price_d, amt_d))
     return cleaned
 
 # export label regex for fallback in main
 __all__ = [
-    "parse_expense_documents", "choose_primary_document", "sanitize_line_items",
-    "parse_forms_key_values", "RE_INV_NUM", "RE_INV_DATE", "RE_TOTAL", "RE_TERMS"
+    "parse_expense_documents", "choose_primary_document", "sanitize_line_items", "LineItem",
+    "parse_forms_key_values", "RE_INV_NUM", "RE_INV_DATE", "RE_TOTAL", "RE_TERMS",
+    "RE_INV_NUM_U", "RE_INV_DATE_U", "RE_TOTAL_U", "RE_TERMS_U"
 ]
@@ -1,17 +1,22 @@
-import sys, json
+import os, sys, json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
 from decimal import Decimal
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import orjson
 
 from client import (
     load_config, get_s3_client, get_textract_client,
-    upload_local_pdf_to_s3, start_expense_job, wait_for_job, fetch_all_pages,
+    upload_local_pdf_to_s3, start_expense_job, wait_for_job, iter_all_pages,
     start_forms_job, wait_for_forms_job, fetch_all_pages_forms
 )
 from expense_parser import (
     parse_expense_documents, parse_forms_key_values,
-    choose_primary_document, sanitize_line_items,
-    RE_INV_NUM, RE_INV_DATE, RE_TERMS
+    choose_primary_document, sanitize_line_items, LineItem,
+    RE_INV_NUM_U, RE_INV_DATE_U, RE_TERMS_U
 )
 from aggregater import merge_documents_by_invoice_number
 from utils import (
@@ -19,46 +24,68 @@ from utils import (
     pretty_money, to_decimal_maybe, is_currency_like, get_default_currency
 )
 
-def _extract_from_kv(kv: Dict[str, str], patterns) -> Optional[str]:
+def artifact_base_name(local_path: str) -> str:
+    return Path(local_path).stem.replace(" ", "_")
+
+def _extract_from_kv(kv: Dict[str, str], pattern) -> Optional[str]:
     for k, v in kv.items():
-        for rx in patterns:
-            if rx.search(k):
-                return v
+        if pattern.search(k):
+            return v
     return None
 
-def print_invoice_report(inv: Dict[str, Any], currency_hint="USD"):
+def stream_json_array(items: Iterable[Dict[str, Any]], path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Write items to `path` as a JSON array while passing each one through,
+    so a large Textract result never has to be held in memory at once.
+    The array is closed even if fetching or the consumer fails part-way,
+    so the pages received so far remain valid JSON.
+    """
+    with open(path, "wb") as fh:
+        fh.write(b"[")
+        try:
+            for i, item in enumerate(items):
+                fh.write(b",\n" if i else b"\n")
+                fh.write(orjson.dumps(item, option=orjson.OPT_INDENT_2, default=str))
+                yield item
+        finally:
+            fh.write(b"\n]\n")
+
+def print_invoice_report(inv: Dict[str, Any], currency_hint="USD",
+                         items: Optional[List[LineItem]] = None):
     inv_no   = clean_text(inv.get("invoiceNumber")) or "-"
     inv_date = normalize_date(inv.get("invoiceDate")) or "-"
     payterms = clean_text(inv.get("paymentTerms")) or "-"
     total_d  = to_decimal_maybe(inv.get("total"))
-    items    = sanitize_line_items(inv.get("lineItems", []))
-    items    = [x for x in items if any([x["description"], x["quantity"], x["unitPrice"], x["amount"]])]
-
-    subtotal = sum([x["amount"] for x in items if x["amount"] is not None], start=Decimal("0"))
-    inferred = sum(1 for x in items if x["amount"] is not None and (x["quantity"] is not None and x["unitPrice"] is not None))
-
-    print("\n================ INVOICE =================")
-    print(f"Invoice Number : {inv_no}")
-    print(f"Invoice Date   : {inv_date}")
-    print(f"Payment Terms  : {payterms}")
-    print("---------------------------------------------------------------")
-    print(f"{'Description':40} {'Qty':>8} {'Unit Price':>14} {'Amount':>14}")
-    print("---------------------------------------------------------------")
+    if items is None:
+        items = sanitize_line_items(inv.get("lineItems", []))
+    items    = [x for x in items if any([x.description, x.quantity, x.unitPrice, x.amount])]
+
+    lines: List[str] = []
+    lines.append("\n================ INVOICE =================")
+    lines.append(f"Invoice Number : {inv_no}")
+    lines.append(f"Invoice Date   : {inv_date}")
+    lines.append(f"Payment Terms  : {payterms}")
+    lines.append("---------------------------------------------------------------")
+    lines.append(f"{'Description':40} {'Qty':>8} {'Unit Price':>14} {'Amount':>14}")
+    lines.append("---------------------------------------------------------------")
     for it in items:
-        desc = (it['description'] or '-')[:40]
-        qty  = f"{it['quantity']}" if it['quantity'] is not None else "-"
-        unit = pretty_money(it['unitPrice'], currency_hint) if it['unitPrice'] is not None else "-"
-        amt  = pretty_money(it['amount'],     currency_hint) if it['amount']     is not None else "-"
-        print(f"{desc:40} {qty:>8} {unit:>14} {amt:>14}")
-    print("---------------------------------------------------------------")
-    print(f"{'Invoice Total:':>54} {pretty_money(total_d, currency_hint):>14}")
-    
-    print("===============================================================\n")
-
-def make_clean_json(inv: Dict[str, Any]) -> Dict[str, Any]:
-    from expense_parser import sanitize_line_items
-    from utils import to_decimal_maybe
-    items = sanitize_line_items(inv.get("lineItems", []))
+        desc = (it.description or '-')[:40]
+        qty  = f"{it.quantity}" if it.quantity is not None else "-"
+        unit = pretty_money(it.unitPrice, currency_hint) if it.unitPrice is not None else "-"
+        amt  = pretty_money(it.amount,     currency_hint) if it.amount     is not None else "-"
+        lines.append(f"{desc:40} {qty:>8} {unit:>14} {amt:>14}")
+    lines.append("---------------------------------------------------------------")
+    lines.append(f"{'Invoice Total:':>54} {pretty_money(total_d, currency_hint):>14}")
+    lines.append("===============================================================\n")
+
+    # one write for the whole table: other workers' status lines can't land inside it
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+def make_clean_json(inv: Dict[str, Any],
+                    items: Optional[List[LineItem]] = None) -> Dict[str, Any]:
+    if items is None:
+        items = sanitize_line_items(inv.get("lineItems", []))
     def dec_to_str(d: Optional[Decimal]) -> Optional[str]:
         return f"{d:.2f}" if d is not None else None
     return {
@@ -67,22 +94,23 @@ def make_clean_json(inv: Dict[str, Any]) -> Dict[str, Any]:
         "paymentTerms":  clean_text(inv.get("paymentTerms")),
         "lineItems": [
             {
-                "description": it["description"],
-                "quantity":    f"{it['quantity']}" if it["quantity"] is not None else None,
-                "unitPrice":   dec_to_str(it["unitPrice"]),
-                "amount":      dec_to_str(it["amount"]),
+                "description": it.description,
+                "quantity":    f"{it.quantity}" if it.quantity is not None else None,
+                "unitPrice":   dec_to_str(it.unitPrice),
+                "amount":      dec_to_str(it.amount),
             }
             for it in items
         ],
         "total": (f"{to_decimal_maybe(inv.get('total')):.2f}" if to_decimal_maybe(inv.get("total")) is not None else None)
     }
 
-def process_local_pdf(local_pdf_path: str, cfg) -> Dict[str, Any]:
+def process_local_pdf(local_pdf_path: str, cfg, s3=None, textract=None) -> Dict[str, Any]:
     bucket, prefix, poll = cfg["S3_BUCKET"], cfg["S3_PREFIX"], cfg["POLL_SECS"]
     region = cfg["REGION"]
 
-    s3       = get_s3_client(region)
-    textract = get_textract_client(region)
+    # boto3 clients are thread-safe; callers may share one pair across workers
+    s3       = s3 or get_s3_client(region)
+    textract = textract or get_textract_client(region)
 
     # 1) upload to S3
     s3_key = upload_local_pdf_to_s3(local_pdf_path, bucket, prefix, s3)
@@ -91,19 +119,20 @@ def process_local_pdf(local_pdf_path: str, cfg) -> Dict[str, Any]:
     job_id = start_expense_job(bucket, s3_key, textract)
     print(f"Started Expense job: {job_id} for s3://{bucket}/{s3_key}")
 
+    # optionally run FORMS concurrently so a later fallback doesn't wait for a fresh job
+    fj = start_forms_job(bucket, s3_key, textract) if cfg.get("SPECULATIVE_FORMS") else None
+
     # 3) wait + fetch pages
     status = wait_for_job(job_id, textract, poll)
     if status not in ("SUCCEEDED", "PARTIAL_SUCCESS"):
         print(f"[!] Job did not succeed: {status}")
         return {"jobId": job_id, "status": status, "s3Key": s3_key}
 
-    pages = fetch_all_pages(job_id, textract)
-
-    # 4) save raw + parsed
-    base_name = Path(local_pdf_path).stem.replace(" ", "_")
-    save_json(pages, f"{base_name}.textract_raw.json")
-
-    initial_parsed = parse_expense_documents(pages)
+    # 4) save raw (streamed page by page while parsing) + parsed
+    base_name = artifact_base_name(local_pdf_path)
+    # closing() finalizes the raw file right away if parsing raises mid-stream
+    with closing(stream_json_array(iter_all_pages(job_id, textract), f"{base_name}.textract_raw.json")) as pages:
+        initial_parsed = parse_expense_documents(pages)
     merged_docs    = merge_documents_by_invoice_number(initial_parsed)
     save_json(merged_docs, f"{base_name}.parsed.json")
 
@@ -117,27 +146,49 @@ def process_local_pdf(local_pdf_path: str, cfg) -> Dict[str, Any]:
     need_dt  = not primary.get("invoiceDate")
     need_trm = not primary.get("paymentTerms")
 
+    # reuse headers already extracted (TYPE or label) from any Expense doc before paying for FORMS
+    if need_inv:
+        inv_no = next((d["invoiceNumber"] for d in initial_parsed
+                       if d.get("invoiceNumber") and not is_currency_like(d["invoiceNumber"])), None)
+        if inv_no:
+            primary["invoiceNumber"] = inv_no
+            need_inv = False
+    if need_dt:
+        inv_dt = next((d["invoiceDate"] for d in initial_parsed if d.get("invoiceDate")), None)
+        if inv_dt:
+            primary["invoiceDate"] = inv_dt
+            need_dt = False
+    if need_trm:
+        inv_terms = next((d["paymentTerms"] for d in initial_parsed if d.get("paymentTerms")), None)
+        if inv_terms:
+            primary["paymentTerms"] = inv_terms
+            need_trm = False
+
     if need_inv or need_dt or need_trm:
-        fj = start_forms_job(bucket, s3_key, textract)
+        if fj is None:
+            fj = start_forms_job(bucket, s3_key, textract)
         fstatus = wait_for_forms_job(fj, textract, poll)
         if fstatus in ("SUCCEEDED", "PARTIAL_SUCCESS"):
             fpages = fetch_all_pages_forms(fj, textract)
             kv = parse_forms_key_values(fpages)
             if need_inv:
-                inv_no = _extract_from_kv(kv, RE_INV_NUM)
+                inv_no = _extract_from_kv(kv, RE_INV_NUM_U)
                 if inv_no and not is_currency_like(inv_no): primary["invoiceNumber"] = inv_no
             if need_dt:
-                inv_dt = _extract_from_kv(kv, RE_INV_DATE)
+                inv_dt = _extract_from_kv(kv, RE_INV_DATE_U)
                 if inv_dt: primary["invoiceDate"] = inv_dt
             if need_trm:
-                inv_terms = _extract_from_kv(kv, RE_TERMS)
+                inv_terms = _extract_from_kv(kv, RE_TERMS_U)
                 if inv_terms: primary["paymentTerms"] = inv_terms
 
     currency_hint = detect_currency_hint(primary) or get_default_currency()
 
-    print_invoice_report(primary, currency_hint=currency_hint)
+    # sanitize once; both the report and the clean JSON use the same rows
+    clean_items = sanitize_line_items(primary.get("lineItems", []))
 
-    clean_obj  = make_clean_json(primary)
+    print_invoice_report(primary, currency_hint=currency_hint, items=clean_items)
+
+    clean_obj  = make_clean_json(primary, items=clean_items)
     clean_path = f"{base_name}_clean.json"
     save_json(clean_obj, clean_path)
 
@@ -159,15 +210,34 @@ if __name__ == "__main__":
         print("Usage: python main.py <invoice.pdf> [<invoice2.pdf> ...]")
         sys.exit(1)
 
-    outputs = []
-    for local in sys.argv[1:]:
+    # artifacts are named by stem; concurrent runs with the same stem would clobber each other
+    dupes = sorted(b for b, n in Counter(artifact_base_name(p) for p in sys.argv[1:]).items() if n > 1)
+    if dupes:
+        print(f"[ERROR] Inputs share output names: {', '.join(dupes)}. Rename or process them separately.")
+        sys.exit(1)
+
+    s3       = get_s3_client(cfg["REGION"], workers=cfg["PARALLEL"])
+    textract = get_textract_client(cfg["REGION"])
+
+    def run_one(local: str) -> Dict[str, Any]:
         print(f"\n=== Processing: {local} ===")
         try:
-            out = process_local_pdf(local, cfg)
+            return process_local_pdf(local, cfg, s3, textract)
         except Exception as e:
-            out = {"status":"ERROR","message":str(e), "file": local}
-            print(f"[ERROR] {e}")
-        outputs.append(out)
+            print(f"[ERROR] {local}: {e}")
+            return {"status":"ERROR","message":str(e), "file": local}
+
+    # IO-bound (S3 + Textract polling): keep several invoices in flight at once
+    ex = ThreadPoolExecutor(max_workers=cfg["PARALLEL"])
+    try:
+        outputs = list(ex.map(run_one, sys.argv[1:]))
+    except KeyboardInterrupt:
+        # drop queued files; exiting the usual way would join workers still polling Textract
+        ex.shutdown(wait=False, cancel_futures=True)
+        print("\n[INTERRUPTED] Stopping; queued files were not processed.")
+        sys.stdout.flush()
+        os._exit(130)
+    ex.shutdown()
 
     print("\n=== SUMMARY ===")
     print(json.dumps(outputs, indent=2))